@@ -1,14 +1,20 @@
+import asyncio
 import configparser
 import logging
-
-from fastapi import FastAPI, Header, HTTPException
-from fastapi.responses import StreamingResponse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+from fastapi import Depends, FastAPI, Header, HTTPException
+from fastapi.responses import Response
 from typing import Optional
-from datetime import datetime, timedelta
-from io import BytesIO
-import base64
-from jinja2 import Template
-import weasyprint
+from datetime import datetime
+from cachetools import LRUCache, TTLCache
+from jinja2 import DictLoader, Environment, FileSystemBytecodeCache, select_autoescape
 
 from starlette.middleware.cors import CORSMiddleware
 
@@ -19,7 +25,43 @@ from AretasPythonAPI.auth import APIAuth
 from AretasPythonAPI.building_maps import BuildingMapAPIClient
 from AretasPythonAPI.entities import ClientLocationView, Point
 
-app = FastAPI()
+from pdf_renderer import init_pdf_worker, render_pdf
+
+logger = logging.getLogger(__name__)
+
+# WeasyPrint worker processes per server process. Every uvicorn/gunicorn worker gets its own pool,
+# so the total number of renderers is this times the number of server workers
+PDF_RENDER_WORKERS = int(os.environ.get("PDF_RENDER_WORKERS", "1"))
+
+# set up by lifespan() when the server starts, so pdf worker processes never load the api config
+api_config: Optional[APIConfig] = None
+pdf_pool: Optional[ProcessPoolExecutor] = None
+
+
+def new_pdf_pool() -> ProcessPoolExecutor:
+    # WeasyPrint rendering is CPU bound, run it in worker processes so it neither blocks the
+    # event loop nor serializes on the GIL. Workers are spawned rather than forked from the threaded server
+    return ProcessPoolExecutor(
+        max_workers=PDF_RENDER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_pdf_worker
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global api_config, pdf_pool
+
+    # parse the api config once at startup rather than on every request
+    api_config = APIConfig('config.cfg')
+    pdf_pool = new_pdf_pool()
+
+    yield
+
+    pdf_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -31,9 +73,104 @@ app.add_middleware(
 )
 
 
-def get_building_map(api_auth: APIAuth, location_id, building_map_id, points: list[Point]):
-    building_maps = BuildingMapAPIClient(api_auth)
+HTML_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Alert Report</title>
+</head>
+<body>
+    <div class="header">
+        <h1>Alert Report</h1>
+    </div>
+    <div class="section">
+        <h2>Alert Details</h2>
+        <p><strong>Alert ID:</strong> {{ alert.id }}</p>
+        <p><strong>Alert Name:</strong> {{ alert.description }}</p>
+        <p><strong>Sensor Type:</strong> {{ alert.sensorType }}</p>
+        <p><strong>Alert Threshold:</strong> {{ alert.threshold }}</p>
+        <p><strong>Duration:</strong> {{ alert.duration }} seconds</p>
+    </div>
+    <div class="section">
+        <h2>Alert Incident</h2>
+        <p><strong>Device MAC:</strong> {{ alert_history.mac }}</p>
+        <p><strong>Event ID:</strong> {{ alert_history.eventId }}</p>
+        <p><strong>Timestamp:</strong> {{ alert_time }}</p>
+        <p><strong>Data:</strong> {{ alert_history.data }}</p>
+        <p><strong>Is Active:</strong> {{ alert_history.isActive }}</p>
+        {% if rtn_time %}
+        <p><strong>Return to Normal Timestamp:</strong> {{ rtn_time }}</p>
+        {% endif %}
+    </div>
+    <div class="section image">
+        <h2>Sensor Data Chart</h2>
+        <img src="{{ chart_image_url }}" alt="Sensor Data Chart" />
+    </div>
+    {% if has_building_map %}
+    <div class="section image">
+        <h2>Building Map</h2>
+        <img src="{{ building_map_image_url }}" alt="Building Map" />
+    </div>
+    {% endif %}
+</body>
+</html>
+"""
+
+# the sensor chart covers the incident padded by an hour on either side
+CHART_PADDING_MS = 3_600_000
+
+# for alerts that haven't returned to normal, chart at most this long after the alert fired
+# instead of pulling every reading up to now
+MAX_ACTIVE_ALERT_WINDOW_MS = 24 * 3_600_000
+
+# in-memory images are referenced from the template by these urls and served by the url fetcher
+CHART_IMAGE_URL = "memory://chart"
+BUILDING_MAP_IMAGE_URL = "memory://building-map"
+
+# compile the report template once at import rather than on every request; the bytecode cache
+# lets new worker processes skip compiling it again
+_TEMPLATE_ENV = Environment(
+    loader=DictLoader({"alert_report.html": HTML_TEMPLATE}),
+    autoescape=select_autoescape(["html"]),
+    bytecode_cache=FileSystemBytecodeCache(),
+    auto_reload=False
+)
+_ALERT_TEMPLATE = _TEMPLATE_ENV.get_template("alert_report.html")
+
+
+# reports for alerts that have returned to normal never change, keep recently rendered ones keyed by
+# (alert history record id, rtn timestamp) and bounded by their total size in bytes.
+# Only touched from the event loop thread
+PDF_CACHE: LRUCache = LRUCache(maxsize=256 * 1024 * 1024, getsizeof=len)
+
+
+@lru_cache(maxsize=256)
+def get_api_clients(access_token: str):
+    """
+    Build (and cache per access token) the api clients used to generate a report
+    """
+    api_auth = APIAuth(api_config, token=access_token)
+    return APIClient(api_auth), APIUtils(api_auth), BuildingMapAPIClient(api_auth)
+
 
+# alert definitions rarely change; fetch_alert downloads the whole alert list to find one alert,
+# so keep them briefly keyed by (access token, alert id). Only touched from the event loop thread
+ALERT_CACHE: TTLCache = TTLCache(maxsize=256, ttl=300)
+
+
+async def fetch_alert_cached(api: APIUtils, access_token: str, alert_id):
+    key = (access_token, alert_id)
+
+    alert = ALERT_CACHE.get(key)
+    if alert is None:
+        alert = await asyncio.to_thread(api.fetch_alert, alert_id)
+        if alert is not None:
+            ALERT_CACHE[key] = alert
+
+    return alert
+
+
+def get_building_map(building_maps: BuildingMapAPIClient, location_id, building_map_id, points: list[Point]):
     try:
         image_data = building_maps.get_map_image_with_points(location_id, building_map_id, points)
 
@@ -45,153 +182,153 @@ def get_building_map(api_auth: APIAuth, location_id, building_map_id, points: li
             return None
 
     except Exception as e:
-        logger.error(e)
+        logger.error("Failed to retrieve the map image with points: %s", e)
         return None
 
 
-@app.get("/generate_alert_pdf/{alert_history_record_id}")
-async def generate_alert_pdf(alert_history_record_id: int, authorization: Optional[str] = Header(None)):
-    logger.info("Attempting to generate AlertHistoryLog pdf")
+async def fetch_sensor_building_map(client: APIClient, building_maps: BuildingMapAPIClient, mac):
+    """
+    Fetch the building map image with the sensor's position marked on it.
+    Returns (whether the sensor is placed on a building map, the map image or None if there is
+    no map or it couldn't be retrieved), so a failed fetch can be told apart from a sensor without a map
+    """
+    # fetch the SensorObject for that mac
+    sensor_obj = await asyncio.to_thread(client.get_sensor_by_mac, mac)
+
+    if not sensor_obj.buildingMapId or len(sensor_obj.buildingMapId) == 0:
+        return False, None
+
+    # the sensor's owner is the id of the Location containing it, no need to fetch the Location itself
+    building_map_img_bytes = await asyncio.to_thread(
+        get_building_map,
+        building_maps,
+        sensor_obj.owner,
+        sensor_obj.buildingMapId,
+        [Point(sensor_obj.imgMapX, sensor_obj.imgMapY, 0.0)]
+    )
+
+    return True, building_map_img_bytes
+
+
+async def render_report_pdf(html_content: str, resources: dict[str, tuple[str, bytes]]) -> bytes:
+    """
+    Render the report in the pdf pool. A worker dying (e.g. running out of memory on a large image)
+    breaks the pool for every later submit, so replace a broken pool and retry once
+    """
+    global pdf_pool
+
+    loop = asyncio.get_running_loop()
+    pool = pdf_pool
+    try:
+        return await loop.run_in_executor(pool, render_pdf, html_content, resources)
+    except BrokenProcessPool:
+        # concurrent requests may all see the same broken pool, only the first one replaces it
+        if pdf_pool is pool:
+            logger.error("PDF worker pool is broken, starting a new one")
+            pdf_pool = new_pdf_pool()
+            pool.shutdown(wait=False)
+
+    return await loop.run_in_executor(pdf_pool, render_pdf, html_content, resources)
 
+
+def pdf_response(pdf: bytes) -> Response:
+    return Response(
+        content=pdf,
+        media_type="application/pdf",
+        headers={"Content-Disposition": "inline; filename=alert_report.pdf"}
+    )
+
+
+async def get_access_token(authorization: Optional[str] = Header(None)) -> str:
+    """
+    Dependency that extracts the access token from the "Bearer <token>" Authorization header.
+    Async so FastAPI runs it on the event loop instead of dispatching it to the threadpool
+    """
     if not authorization:
-        print("Missing authorization header!")
+        logger.warning("Missing authorization header!")
         raise HTTPException(status_code=401, detail="Authorization header missing")
 
-        # Extract the token from the "Bearer <token>" format
-    if not authorization.startswith("Bearer "):
+    # Extract the token from the "Bearer <token>" format
+    access_token = authorization.removeprefix("Bearer ")
+    if len(access_token) == len(authorization):
         raise HTTPException(status_code=401, detail="Invalid Authorization header format")
 
-    access_token = authorization.split(" ")[1]
+    return access_token
 
-    config = APIConfig('config.cfg')
-    api_auth = APIAuth(config, token=access_token)
-    client = APIClient(api_auth)
 
-    client_location_view: ClientLocationView = client.get_client_location_view()
-
-    api = APIUtils(api_auth)
+@app.get("/generate_alert_pdf/{alert_history_record_id}", response_class=Response)
+async def generate_alert_pdf(alert_history_record_id: int, access_token: str = Depends(get_access_token)):
+    logger.info("Attempting to generate AlertHistoryLog pdf")
 
-    # fetch the Location containing that SensorObject
+    client, api, building_maps = get_api_clients(access_token)
+
+    # Fetch data. The client location view is requested and completed first, as it always was
+    client_location_view: ClientLocationView = await asyncio.to_thread(client.get_client_location_view)
+    alert_history_record = await asyncio.to_thread(api.fetch_alert_history_record, alert_history_record_id)
+
+    # the record was fetched with the caller's token, so a cached report is only served to callers that can see it
+    is_resolved = alert_history_record.rtnTimestamp > 0
+    pdf_cache_key = (alert_history_record_id, alert_history_record.rtnTimestamp)
+    if is_resolved and pdf_cache_key in PDF_CACHE:
+        return pdf_response(PDF_CACHE[pdf_cache_key])
+
+    # Calculate the chart window with padding, as plain epoch milliseconds
+    if is_resolved:
+        incident_end_ms = alert_history_record.rtnTimestamp
+    else:
+        incident_end_ms = min(int(time.time() * 1000),
+                              alert_history_record.timestamp + MAX_ACTIVE_ALERT_WINDOW_MS)
+    start_time = alert_history_record.timestamp - CHART_PADDING_MS
+    end_time = incident_end_ms + CHART_PADDING_MS
+
+    # the alert definition, the chart and the building map only depend on the history record,
+    # fetch them concurrently
+    alert, chart_image_bytes, (sensor_on_map, building_map_img_bytes) = await asyncio.gather(
+        fetch_alert_cached(api, access_token, alert_history_record.alertId),
+        asyncio.to_thread(api.fetch_image_plotly,
+                          alert_history_record.mac,
+                          start_time,
+                          end_time,
+                          [alert_history_record.type]),
+        fetch_sensor_building_map(client, building_maps, alert_history_record.mac)
+    )
 
-    # Fetch data
-    alert_history_record = api.fetch_alert_history_record(alert_history_record_id)
-    alert = api.fetch_alert(alert_history_record.alertId)
-
-    # fetch the SensorObject for that mac
-    sensor_obj = client.get_sensor_by_mac(alert_history_record.mac)
-    location_obj = client.get_location_by_id(sensor_obj.owner)
-
-    # Calculate times with padding
-    alert_time = datetime.fromtimestamp(alert_history_record.timestamp / 1000)
-    rtn_time = datetime.fromtimestamp(
-        alert_history_record.rtnTimestamp / 1000) if alert_history_record.rtnTimestamp > 0 else datetime.now()
-    start_time = int((alert_time - timedelta(hours=1)).timestamp() * 1000)
-    end_time = int((rtn_time + timedelta(hours=1)).timestamp() * 1000)
-
-    building_map_img_base64 = None
-    has_building_map = False
-
-    if sensor_obj.buildingMapId and len(sensor_obj.buildingMapId) > 0:
-        try:
-            building_map_img_bytes = get_building_map(
-                api_auth,
-                location_obj.location.id,
-                sensor_obj.buildingMapId,
-                [Point(sensor_obj.imgMapX, sensor_obj.imgMapY, 0.0)]
-            )
-            building_map_img_base64 = base64.b64encode(building_map_img_bytes).decode('utf-8')
-            has_building_map = True
-        except Exception as e:
-            logger.error(e)
-
-    # Fetch chart image
-    chart_image_bytes = api.fetch_image_plotly(alert_history_record.mac,
-                                               start_time,
-                                               end_time,
-                                               [alert_history_record.type])
-
-    chart_image_base64 = base64.b64encode(chart_image_bytes).decode('utf-8')
+    has_building_map = building_map_img_bytes is not None
 
     # Prepare template data
-    alert_time_str = alert_time.strftime('%Y-%m-%d %H:%M:%S')
-    rtn_time_str = rtn_time.strftime('%Y-%m-%d %H:%M:%S') if alert_history_record.rtnTimestamp > 0 else None
-
-    html_template = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Alert Report</title>
-        <style>
-            body { font-family: Arial, sans-serif; }
-            h1 { text-align: center; }
-            .section { margin: 20px; }
-            .header { background-color: #f0f0f0; padding: 10px; }
-            .content { padding: 10px; }
-            .image { text-align: center; margin-top: 20px; }
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>Alert Report</h1>
-        </div>
-        <div class="section">
-            <h2>Alert Details</h2>
-            <p><strong>Alert ID:</strong> {{ alert.id }}</p>
-            <p><strong>Alert Name:</strong> {{ alert.description }}</p>
-            <p><strong>Sensor Type:</strong> {{ alert.sensorType }}</p>
-            <p><strong>Alert Threshold:</strong> {{ alert.threshold }}</p>
-            <p><strong>Duration:</strong> {{ alert.duration }} seconds</p>
-        </div>
-        <div class="section">
-            <h2>Alert Incident</h2>
-            <p><strong>Device MAC:</strong> {{ alert_history.mac }}</p>
-            <p><strong>Event ID:</strong> {{ alert_history.eventId }}</p>
-            <p><strong>Timestamp:</strong> {{ alert_time }}</p>
-            <p><strong>Data:</strong> {{ alert_history.data }}</p>
-            <p><strong>Is Active:</strong> {{ alert_history.isActive }}</p>
-            {% if rtn_time %}
-            <p><strong>Return to Normal Timestamp:</strong> {{ rtn_time }}</p>
-            {% endif %}
-        </div>
-        <div class="section image">
-            <h2>Sensor Data Chart</h2>
-            <img width="500" height="500" src="data:image/jpeg;base64,{{ chart_image_base64 }}" alt="Sensor Data Chart" />
-        </div>
-        {% if has_building_map %}
-        <div class="section image">
-            <h2>Building Map</h2>
-            <img width="500" height="500" src="data:image/png;base64,{{ building_map_img_base64 }}" alt="Building Map" />
-        </div>
-        {% endif %}
-    </body>
-    </html>
-    """
+    alert_time_str = datetime.fromtimestamp(alert_history_record.timestamp / 1000).strftime('%Y-%m-%d %H:%M:%S')
+    rtn_time_str = datetime.fromtimestamp(
+        alert_history_record.rtnTimestamp / 1000).strftime('%Y-%m-%d %H:%M:%S') if is_resolved else None
 
-    template = Template(html_template)
-    html_content = template.render(
+    html_content = _ALERT_TEMPLATE.render(
         alert=alert,
         alert_history=alert_history_record,
         alert_time=alert_time_str,
         rtn_time=rtn_time_str,
-        chart_image_base64=chart_image_base64,
+        chart_image_url=CHART_IMAGE_URL,
         has_building_map=has_building_map,
-        building_map_img_base64=building_map_img_base64
+        building_map_image_url=BUILDING_MAP_IMAGE_URL
     )
 
     # Generate PDF
-    pdf = weasyprint.HTML(string=html_content).write_pdf(presentational_hints=True)
+    resources = {
+        CHART_IMAGE_URL: ("image/jpeg", chart_image_bytes)
+    }
+    if has_building_map:
+        resources[BUILDING_MAP_IMAGE_URL] = ("image/png", building_map_img_bytes)
+    pdf = await render_report_pdf(html_content, resources)
 
-    return StreamingResponse(
-        BytesIO(pdf),
-        media_type="application/pdf",
-        headers={"Content-Disposition": "inline; filename=alert_report.pdf"}
-    )
+    # don't let a transient upstream failure get cached as the permanent report for this alert
+    report_complete = alert is not None and (has_building_map or not sensor_on_map)
+    if is_resolved and report_complete:
+        PDF_CACHE[pdf_cache_key] = pdf
 
+    return pdf_response(pdf)
 
-logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
     import uvicorn
 
-    # Only run if this file is executed directly
+    # Only run if this file is executed directly. Spawned pdf workers re-import this script as __mp_main__,
+    # prefer starting the service with the uvicorn CLI (see the README)
     uvicorn.run(app, host="0.0.0.0", port=8100, log_level="info")
@@ -0,0 +1,67 @@
+from typing import Optional
+
+import weasyprint
+from weasyprint.text.fonts import FontConfiguration
+from weasyprint.urls import URLFetcherResponse
+
+# Kept free of the API module's imports and startup work, so pdf worker processes only need this module.
+# They still re-import the API module when it is the __main__ script, see the README
+
+REPORT_CSS = """
+body { font-family: Arial, sans-serif; }
+h1 { text-align: center; }
+.section { margin: 20px; }
+.header { background-color: #f0f0f0; padding: 10px; }
+.image { text-align: center; margin-top: 20px; }
+.image img { width: 500px; height: 500px; }
+"""
+
+
+class ResourceURLFetcher(weasyprint.URLFetcher):
+    """
+    WeasyPrint url fetcher that serves the given in-memory resources, keyed by url as (mime_type, body),
+    and fetches anything else as usual
+    """
+
+    def __init__(self, resources: dict[str, tuple[str, bytes]], **kwargs):
+        super().__init__(**kwargs)
+        self.resources = resources
+
+    def fetch(self, url, headers=None):
+        if url in self.resources:
+            mime_type, body = self.resources[url]
+            return URLFetcherResponse(url, body=body, headers={"Content-Type": mime_type})
+        return super().fetch(url, headers)
+
+
+# WeasyPrint state owned by each pdf worker process, built once per process by init_pdf_worker()
+_font_config: Optional[FontConfiguration] = None
+_report_stylesheet: Optional[weasyprint.CSS] = None
+
+
+def init_pdf_worker():
+    """
+    Build the font configuration and parse the report stylesheet once for this process,
+    then render a trivial document so the first real report doesn't pay WeasyPrint's warm-up cost
+    """
+    global _font_config, _report_stylesheet
+
+    _font_config = FontConfiguration()
+    _report_stylesheet = weasyprint.CSS(string=REPORT_CSS, font_config=_font_config)
+
+    render_pdf("<html><body></body></html>", {})
+
+
+def render_pdf(html_content: str, resources: dict[str, tuple[str, bytes]]) -> bytes:
+    """
+    Render the report html to pdf bytes, serving the in-memory resources through the url fetcher.
+    Runs inside the pdf worker processes so it must stay a picklable module-level function
+    """
+    if _report_stylesheet is None:
+        init_pdf_worker()
+
+    return weasyprint.HTML(string=html_content, url_fetcher=ResourceURLFetcher(resources)).write_pdf(
+        stylesheets=[_report_stylesheet],
+        font_config=_font_config,
+        optimize_images=True
+    )